@@ -36,20 +36,38 @@ Example of configuration:
 The same Authenticator class can be used several to support different providers.
 
 """
+
 try:
     # Python < 3.10
     from importlib_metadata import entry_points
 except ImportError:
     from importlib.metadata import entry_points
+
+import asyncio
+import hashlib
+import json
+import time
 import warnings
 
+from collections import OrderedDict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from jupyterhub.apihandlers import APIHandler
 from jupyterhub.auth import Authenticator
+from jupyterhub.scopes import needs_scope
+from jupyterhub.utils import maybe_future
 from jupyterhub.utils import url_path_join
+from traitlets import Bool
+from traitlets import Float
+from traitlets import Integer
 from traitlets import List
 from traitlets import Unicode
 from traitlets import import_item
 
 PREFIX_SEPARATOR = ":"
+AUTH_STATE_URL_PREFIX_KEY = "multiauthenticator_url_prefix"
+STATS_PATH = "/api/multiauthenticator/stats"
 
 
 def _load_authenticator(authenticator_name):
@@ -92,6 +110,62 @@ def removeprefix(self: str, prefix: str) -> str:
         return self[:]
 
 
+def _spawn_fingerprint(auth_state, user_options):
+    """Return a stable digest of the spawn inputs used to detect changes between spawns"""
+    serialized = json.dumps(
+        {"auth_state": auth_state, "user_options": user_options},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class AuthenticatorStats:
+    """Live statistics of a subauthenticator
+
+    Authentication latencies are kept in a fixed-size ring buffer so that the
+    percentiles reflect recent activity only.
+    """
+
+    def __init__(self, latency_samples):
+        self.load_time = 0.0
+        self.instantiation_time = 0.0
+        self.in_flight = 0
+        self.latencies = deque(maxlen=latency_samples)
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)):
+        """Return the nearest-rank percentiles of the recorded latencies"""
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return {f"p{percentile}": None for percentile in percentiles}
+        return {
+            f"p{percentile}": latencies[
+                max(0, -(-percentile * len(latencies) // 100) - 1)
+            ]
+            for percentile in percentiles
+        }
+
+    def cache_hit_rate(self):
+        lookups = self.cache_hits + self.cache_misses
+        if lookups == 0:
+            return None
+        return self.cache_hits / lookups
+
+
+class StatsHandler(APIHandler):
+    """Handler reporting the statistics of the subauthenticators
+
+    Requires the read:metrics scope like JupyterHub's own metrics endpoint.
+    """
+
+    @needs_scope("read:metrics")
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(self.authenticator.get_stats()))
+
+
 class MultiAuthenticator(Authenticator):
     """Wrapper class that allows to use more than one authentication provider
     for JupyterHub"""
@@ -103,10 +177,57 @@ class MultiAuthenticator(Authenticator):
         allow_none=True,
         default_value=None,
     )
+    spawn_hook_timeout = Float(
+        help="""Timeout in seconds for the spawn hooks delegated to subauthenticators
+
+        Can be overridden per subauthenticator with the "spawn_hook_timeout" key
+        of its entry. A value of 0 disables the timeout.
+        """,
+        config=True,
+        default_value=30,
+    )
+    cache_spawn_environment = Bool(
+        help="""Reuse the environment set by a subauthenticator's pre_spawn_start
+        hook on the next starts of the same server, as long as the user's
+        auth_state and the user_options are unchanged.
+
+        Only the environment is replayed: any other change the hook makes to the
+        spawner is not applied on cache hits. The cache is kept in memory, see
+        spawn_environment_cache_size.
+        """,
+        config=True,
+        default_value=False,
+    )
+    spawn_environment_cache_size = Integer(
+        help="""Maximum number of servers whose spawn environment is cached
+
+        The least recently started servers are evicted first.
+        """,
+        config=True,
+        default_value=1000,
+    )
+    construction_workers = Integer(
+        help="""Number of threads used to load and instantiate the subauthenticators
+        at startup. 1 builds them serially in the calling thread, 0 uses the
+        executor's default.
+
+        With more than one thread, the subauthenticators' constructors run in
+        worker threads without an event loop: they must be thread-safe and must
+        not rely on IOLoop.current() or create loop-bound objects.
+        """,
+        config=True,
+        default_value=1,
+    )
+    stats_latency_samples = Integer(
+        help="Number of recent authentication latencies kept per subauthenticator",
+        config=True,
+        default_value=100,
+    )
 
     def __init__(self, *arg, **kwargs):
         super().__init__(*arg, **kwargs)
-        self._authenticators = []
+        self._spawn_environment_cache = OrderedDict()
+        entries = []
         for entry in self.authenticators:
             if isinstance(entry, (list, tuple)):
                 tuple_entry = entry
@@ -121,68 +242,289 @@ class MultiAuthenticator(Authenticator):
                     DeprecationWarning,
                 )
 
-            authenticator_klass = entry["authenticator_class"]
-            url_scope_authenticator = entry["url_prefix"]
-            authenticator_configuration = entry.get("config", {})
+            entries.append(entry)
+
+        results = []
+        if self.construction_workers == 1:
+            for entry in entries:
+                try:
+                    results.append(self._build_authenticator(entry))
+                except Exception as error:
+                    results.append(error)
+        else:
+            with ThreadPoolExecutor(
+                max_workers=self.construction_workers or None
+            ) as executor:
+                futures = [
+                    executor.submit(self._build_authenticator, entry)
+                    for entry in entries
+                ]
+            for future in futures:
+                error = future.exception()
+                results.append(future.result() if error is None else error)
 
-            if isinstance(authenticator_klass, str):
-                authenticator_klass = _load_authenticator(authenticator_klass)
+        self._authenticators = []
+        errors = []
+        for index, (entry, result) in enumerate(zip(entries, results)):
+            if isinstance(result, Exception):
+                label = f"entry {index} ({entry.get('url_prefix')})"
+                errors.append((label, result))
+                continue
+            self.log.info(
+                "Loaded %s for %s in %.3fs (import: %.3fs, instantiation: %.3fs)",
+                result.login_service,
+                result.url_scope,
+                result._stats.load_time + result._stats.instantiation_time,
+                result._stats.load_time,
+                result._stats.instantiation_time,
+            )
+            self._authenticators.append(result)
+
+        if len(errors) == 1:
+            raise errors[0][1]
+        elif errors:
+            for label, error in errors:
+                self.log.error(
+                    "Failed to configure subauthenticator %s",
+                    label,
+                    exc_info=error,
+                )
+            details = "\n".join(f"  {label}: {error!r}" for label, error in errors)
+            raise ValueError(
+                f"Failed to configure {len(errors)} subauthenticators:\n{details}"
+            ) from errors[0][1]
 
-            class WrapperAuthenticator(URLScopeMixin, authenticator_klass):
-                url_scope = url_scope_authenticator
+    def _build_authenticator(self, entry):
+        """Load and instantiate the subauthenticator described by entry
 
-                @property
-                def username_prefix(self):
-                    prefix = getattr(self, "prefix", None)
-                    if prefix is None:
-                        prefix = f"{getattr(self, 'service_name', self.login_service)}{PREFIX_SEPARATOR}"
-                    return self.normalize_username(prefix)
+        May be called concurrently for all entries, see construction_workers.
+        """
+        authenticator_klass = entry["authenticator_class"]
+        url_scope_authenticator = entry["url_prefix"]
+        authenticator_configuration = entry.get("config", {})
+        if url_scope_authenticator.strip("/").split("/")[0] == "api":
+            raise ValueError(
+                f"URL prefix cannot be under /api: {url_scope_authenticator}"
+            )
+        spawn_hook_timeout_authenticator = entry.get(
+            "spawn_hook_timeout", self.spawn_hook_timeout
+        )
+        if (
+            isinstance(spawn_hook_timeout_authenticator, bool)
+            or not isinstance(spawn_hook_timeout_authenticator, (int, float))
+            or spawn_hook_timeout_authenticator < 0
+        ):
+            raise ValueError(
+                "spawn_hook_timeout must be a non-negative number, got"
+                f" {spawn_hook_timeout_authenticator!r}"
+            )
 
-                async def authenticate(self, handler, data=None, **kwargs):
+        stats = AuthenticatorStats(self.stats_latency_samples)
+
+        if isinstance(authenticator_klass, str):
+            start = time.perf_counter()
+            authenticator_klass = _load_authenticator(authenticator_klass)
+            stats.load_time = time.perf_counter() - start
+
+        class WrapperAuthenticator(URLScopeMixin, authenticator_klass):
+            url_scope = url_scope_authenticator
+            spawn_hook_timeout = spawn_hook_timeout_authenticator
+            _stats = stats
+            _authenticator_class = authenticator_klass
+
+            @property
+            def username_prefix(self):
+                prefix = getattr(self, "prefix", None)
+                if prefix is None:
+                    prefix = f"{getattr(self, 'service_name', self.login_service)}{PREFIX_SEPARATOR}"
+                return self.normalize_username(prefix)
+
+            async def authenticate(self, handler, data=None, **kwargs):
+                self._stats.in_flight += 1
+                start = time.perf_counter()
+                try:
                     response = await super().authenticate(handler, data, **kwargs)
-                    if response is None:
-                        return None
-                    elif type(response) == str:
-                        return self.username_prefix + response
-                    else:
-                        response["name"] = self.username_prefix + response["name"]
-                        return response
-
-                def check_allowed(self, username, authentication=None):
-                    if not username.startswith(self.username_prefix):
-                        return False
-
-                    return super().check_allowed(
-                        removeprefix(username, self.username_prefix), authentication
-                    )
-
-                def check_blocked_users(self, username, authentication=None):
-                    if not username.startswith(self.username_prefix):
-                        return False
-
-                    return super().check_blocked_users(
-                        removeprefix(username, self.username_prefix), authentication
-                    )
-
-            service_name = authenticator_configuration.pop("service_name", None)
-
-            authenticator = WrapperAuthenticator(
-                parent=self, **authenticator_configuration
-            )
+                finally:
+                    self._stats.in_flight -= 1
+                    self._stats.latencies.append(time.perf_counter() - start)
+                if response is None:
+                    return None
+                elif type(response) == str:
+                    response = {"name": response}
+                response["name"] = self.username_prefix + response["name"]
+                auth_state = response.get("auth_state") or {}
+                auth_state[AUTH_STATE_URL_PREFIX_KEY] = self.url_scope
+                response["auth_state"] = auth_state
+                return response
+
+            def check_allowed(self, username, authentication=None):
+                if not username.startswith(self.username_prefix):
+                    return False
+
+                return super().check_allowed(
+                    removeprefix(username, self.username_prefix), authentication
+                )
 
-            if self.username_prefix is not None:
-                authenticator.prefix = self.username_prefix
-            elif service_name is not None:
-                self.log.warning(
-                    "service_name is deprecated, please create a subclass and set the login_service class variable"
+            def check_blocked_users(self, username, authentication=None):
+                if not username.startswith(self.username_prefix):
+                    return False
+
+                return super().check_blocked_users(
+                    removeprefix(username, self.username_prefix), authentication
                 )
-                if PREFIX_SEPARATOR in service_name:
-                    raise ValueError(f"Service name cannot contain {PREFIX_SEPARATOR}")
-                authenticator.service_name = service_name
-            elif PREFIX_SEPARATOR in authenticator.login_service:
-                raise ValueError(f"Login service cannot contain {PREFIX_SEPARATOR}")
 
-            self._authenticators.append(authenticator)
+        service_name = authenticator_configuration.pop("service_name", None)
+
+        start = time.perf_counter()
+        authenticator = WrapperAuthenticator(parent=self, **authenticator_configuration)
+        stats.instantiation_time = time.perf_counter() - start
+
+        if self.username_prefix is not None:
+            authenticator.prefix = self.username_prefix
+        elif service_name is not None:
+            self.log.warning(
+                "service_name is deprecated, please create a subclass and set the login_service class variable"
+            )
+            if PREFIX_SEPARATOR in service_name:
+                raise ValueError(f"Service name cannot contain {PREFIX_SEPARATOR}")
+            authenticator.service_name = service_name
+        elif PREFIX_SEPARATOR in authenticator.login_service:
+            raise ValueError(f"Login service cannot contain {PREFIX_SEPARATOR}")
+
+        return authenticator
+
+    def _get_authenticator(self, user, auth_state):
+        """Return the subauthenticator owning user
+
+        The owner is recorded in auth_state at login. When auth_state is not
+        available or refers to a URL prefix that is no longer configured, fall
+        back to the username prefix if it is unique.
+        """
+        url_prefix = (auth_state or {}).get(AUTH_STATE_URL_PREFIX_KEY)
+        if url_prefix is not None:
+            for authenticator in self._authenticators:
+                if authenticator.url_scope == url_prefix:
+                    return authenticator
+            self.log.warning(
+                "Subauthenticator %s of %s is not configured anymore,"
+                " falling back to the username prefix",
+                url_prefix,
+                user.name,
+            )
+
+        username_prefixes = [
+            authenticator.username_prefix for authenticator in self._authenticators
+        ]
+        if len(set(username_prefixes)) != len(username_prefixes):
+            self.log.warning(
+                "Cannot find the subauthenticator of %s: username prefixes are not"
+                " unique",
+                user.name,
+            )
+            return None
+
+        for authenticator in self._authenticators:
+            if user.name.startswith(authenticator.username_prefix):
+                return authenticator
+        return None
+
+    async def _run_spawn_hook(self, authenticator, hook, user, spawner):
+        try:
+            await asyncio.wait_for(
+                maybe_future(hook(user, spawner)),
+                timeout=authenticator.spawn_hook_timeout or None,
+            )
+        except asyncio.TimeoutError:
+            message = (
+                f"{hook.__name__} of {authenticator.login_service} timed out after"
+                f" {authenticator.spawn_hook_timeout}s for {user.name}"
+            )
+            self.log.warning("%s", message)
+            raise asyncio.TimeoutError(message) from None
+
+    async def pre_spawn_start(self, user, spawner):
+        """Delegate the hook to the subauthenticator owning the user
+
+        When cache_spawn_environment is enabled, the environment changes made
+        by the subauthenticator are stored and reapplied without calling it the
+        next time the server is started with the same auth_state and
+        user_options.
+        """
+        auth_state = await user.get_auth_state()
+        authenticator = self._get_authenticator(user, auth_state)
+        if authenticator is None:
+            return
+
+        if not self.cache_spawn_environment:
+            await self._run_spawn_hook(
+                authenticator, authenticator.pre_spawn_start, user, spawner
+            )
+            return
+
+        key = (user.name, spawner.name)
+        fingerprint = _spawn_fingerprint(auth_state, spawner.user_options)
+        cached = self._spawn_environment_cache.get(key)
+        if cached is not None and cached[0] == fingerprint:
+            authenticator._stats.cache_hits += 1
+            self._spawn_environment_cache.move_to_end(key)
+            _, updated, removed = cached
+            spawner.environment.update(updated)
+            for name in removed:
+                spawner.environment.pop(name, None)
+            return
+
+        authenticator._stats.cache_misses += 1
+        environment = dict(spawner.environment)
+        await self._run_spawn_hook(
+            authenticator, authenticator.pre_spawn_start, user, spawner
+        )
+        self._spawn_environment_cache[key] = (
+            fingerprint,
+            {
+                name: value
+                for name, value in spawner.environment.items()
+                if name not in environment or environment[name] != value
+            },
+            [name for name in environment if name not in spawner.environment],
+        )
+        self._spawn_environment_cache.move_to_end(key)
+        while len(self._spawn_environment_cache) > self.spawn_environment_cache_size:
+            self._spawn_environment_cache.popitem(last=False)
+
+    async def post_spawn_stop(self, user, spawner):
+        """Delegate the hook to the subauthenticator owning the user"""
+        auth_state = await user.get_auth_state()
+        authenticator = self._get_authenticator(user, auth_state)
+        if authenticator is None:
+            return
+
+        try:
+            await self._run_spawn_hook(
+                authenticator, authenticator.post_spawn_stop, user, spawner
+            )
+        except asyncio.TimeoutError:
+            pass
+
+    def get_stats(self):
+        """Return the live statistics of each configured subauthenticator"""
+        stats = []
+        for authenticator in self._authenticators:
+            klass = authenticator._authenticator_class
+            stats.append(
+                {
+                    "url_prefix": authenticator.url_scope,
+                    "username_prefix": authenticator.username_prefix,
+                    "class": f"{klass.__module__}.{klass.__qualname__}",
+                    "load_time": authenticator._stats.load_time,
+                    "instantiation_time": authenticator._stats.instantiation_time,
+                    "in_flight": authenticator._stats.in_flight,
+                    "latency": authenticator._stats.latency_percentiles(),
+                    "spawn_environment_cache_hit_rate": (
+                        authenticator._stats.cache_hit_rate()
+                    ),
+                }
+            )
+        return stats
 
     def get_custom_html(self, base_url):
         """Re-implementation generating one login button per configured authenticator
@@ -228,4 +570,5 @@ class MultiAuthenticator(Authenticator):
                     authenticator = _authenticator
 
                 routes.append((path, WrapperHandler))
+        routes.append((STATS_PATH, StatsHandler))
         return routes
@@ -9,7 +9,9 @@ from oauthenticator.gitlab import GitLabOAuthenticator
 from oauthenticator.google import GoogleOAuthenticator
 
 from ..multiauthenticator import PREFIX_SEPARATOR
+from ..multiauthenticator import STATS_PATH
 from ..multiauthenticator import MultiAuthenticator
+from ..multiauthenticator import StatsHandler
 
 
 def test_service_name():
@@ -76,8 +78,9 @@ def test_same_authenticators():
     assert multi_authenticator.get_custom_html("").count("\n") == 13
 
     handlers = multi_authenticator.get_handlers("")
-    assert len(handlers) == 6
-    for path, handler in handlers:
+    assert len(handlers) == 7
+    assert handlers[-1] == (STATS_PATH, StatsHandler)
+    for path, handler in handlers[:-1]:
         assert isinstance(handler.authenticator, GoogleOAuthenticator)
         if "mygoogle" in path:
             assert handler.authenticator.service_name == "My Google"
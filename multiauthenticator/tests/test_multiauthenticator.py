@@ -2,19 +2,33 @@
 #
 # SPDX-License-Identifier: BSD-3-Clause
 """Test module for the MultiAuthenticator class"""
+import asyncio
+import json
+import logging
+import re
+import threading
+
+from unittest import mock
+
 import jupyterhub
 import pytest
 
 from jinja2 import Template
 from jupyterhub.auth import DummyAuthenticator
 from jupyterhub.auth import PAMAuthenticator
+from jupyterhub.scopes import Scope
 from oauthenticator import OAuthenticator
 from oauthenticator.github import GitHubOAuthenticator
 from oauthenticator.gitlab import GitLabOAuthenticator
 from packaging.version import Version
+from tornado import web
+from tornado.httputil import HTTPServerRequest
 
+from ..multiauthenticator import AUTH_STATE_URL_PREFIX_KEY
 from ..multiauthenticator import PREFIX_SEPARATOR
+from ..multiauthenticator import STATS_PATH
 from ..multiauthenticator import MultiAuthenticator
+from ..multiauthenticator import StatsHandler
 
 
 class CustomDummyAuthenticator(DummyAuthenticator):
@@ -56,9 +70,12 @@ def test_different_authenticators():
     assert multi_authenticator.get_custom_html("").count("\n") == 20
 
     routes = multi_authenticator.get_handlers("")
-    assert len(routes) == 7
+    assert len(routes) == 8
+    assert routes[-1] == (STATS_PATH, StatsHandler)
 
-    authenticators = {handler.authenticator for _, handler in routes}
+    authenticators = {
+        handler.authenticator for _, handler in routes if handler is not StatsHandler
+    }
 
     assert len(authenticators) == 3
 
@@ -317,3 +334,445 @@ async def test_prefix(prefix, expected):
         None, {"username": "test"}
     )
     assert user["name"] == expected
+
+
+class SpawnHookDummyAuthenticator(CustomDummyAuthenticator):
+    pre_spawn_calls = 0
+    post_spawn_calls = 0
+
+    async def pre_spawn_start(self, user, spawner):
+        SpawnHookDummyAuthenticator.pre_spawn_calls += 1
+        auth_state = await user.get_auth_state()
+        spawner.environment["TOKEN"] = auth_state["token"]
+
+    def post_spawn_stop(self, user, spawner):
+        SpawnHookDummyAuthenticator.post_spawn_calls += 1
+
+
+class SlowDummyAuthenticator(CustomDummyAuthenticator):
+    login_service = "Slow"
+
+    async def pre_spawn_start(self, user, spawner):
+        await asyncio.sleep(1)
+
+
+class FakeUser:
+    def __init__(self, name, auth_state):
+        self.name = name
+        self.auth_state = auth_state
+
+    async def get_auth_state(self):
+        return self.auth_state
+
+
+class FakeSpawner:
+    def __init__(self, name="", user_options=None):
+        self.name = name
+        self.user_options = user_options or {}
+        self.environment = {}
+
+
+@pytest.mark.asyncio
+async def test_spawn_hooks_delegation():
+    MultiAuthenticator.username_prefix = None
+    MultiAuthenticator.authenticators = [
+        {"authenticator_class": CustomPAMAuthenticator, "url_prefix": "/pam"},
+        {"authenticator_class": SpawnHookDummyAuthenticator, "url_prefix": "/dummy"},
+    ]
+    SpawnHookDummyAuthenticator.pre_spawn_calls = 0
+    SpawnHookDummyAuthenticator.post_spawn_calls = 0
+
+    multi_authenticator = MultiAuthenticator()
+    user = FakeUser(f"DUMMY{PREFIX_SEPARATOR}TEST", {"token": "abc"})
+    spawner = FakeSpawner()
+
+    await multi_authenticator.pre_spawn_start(user, spawner)
+    assert spawner.environment == {"TOKEN": "abc"}
+    assert SpawnHookDummyAuthenticator.pre_spawn_calls == 1
+
+    await multi_authenticator.post_spawn_stop(user, spawner)
+    assert SpawnHookDummyAuthenticator.post_spawn_calls == 1
+
+    # Unknown prefixes are ignored
+    await multi_authenticator.pre_spawn_start(FakeUser("unknown", {}), FakeSpawner())
+    assert SpawnHookDummyAuthenticator.pre_spawn_calls == 1
+
+
+@pytest.mark.asyncio
+async def test_spawn_environment_cache():
+    MultiAuthenticator.username_prefix = None
+    MultiAuthenticator.authenticators = [
+        {"authenticator_class": SpawnHookDummyAuthenticator, "url_prefix": "/dummy"},
+    ]
+    SpawnHookDummyAuthenticator.pre_spawn_calls = 0
+
+    multi_authenticator = MultiAuthenticator(
+        cache_spawn_environment=True, spawn_environment_cache_size=2
+    )
+    user = FakeUser(f"DUMMY{PREFIX_SEPARATOR}TEST", {"token": "abc"})
+
+    async def start_stop(spawner):
+        await multi_authenticator.pre_spawn_start(user, spawner)
+        await multi_authenticator.post_spawn_stop(user, spawner)
+        return spawner.environment
+
+    # Entries are kept across stops
+    for _ in range(2):
+        assert await start_stop(FakeSpawner()) == {"TOKEN": "abc"}
+    assert SpawnHookDummyAuthenticator.pre_spawn_calls == 1
+
+    # A changed auth_state invalidates the entry
+    user.auth_state = {"token": "def"}
+    for _ in range(2):
+        assert await start_stop(FakeSpawner()) == {"TOKEN": "def"}
+    assert SpawnHookDummyAuthenticator.pre_spawn_calls == 2
+
+    # Named servers are cached separately
+    for _ in range(2):
+        assert await start_stop(FakeSpawner(name="other")) == {"TOKEN": "def"}
+    assert SpawnHookDummyAuthenticator.pre_spawn_calls == 3
+
+    # A changed user_options invalidates the entry
+    for _ in range(2):
+        await start_stop(FakeSpawner(user_options={"profile": "gpu"}))
+    assert SpawnHookDummyAuthenticator.pre_spawn_calls == 4
+
+    # The least recently started server is evicted
+    await start_stop(FakeSpawner(name="third"))
+    assert list(multi_authenticator._spawn_environment_cache) == [
+        (user.name, ""),
+        (user.name, "third"),
+    ]
+    await start_stop(FakeSpawner(name="other"))
+    assert SpawnHookDummyAuthenticator.pre_spawn_calls == 6
+
+
+@pytest.mark.asyncio
+async def test_spawn_environment_cache_removed_variables():
+    class RemovingDummyAuthenticator(CustomDummyAuthenticator):
+        def pre_spawn_start(self, user, spawner):
+            spawner.environment.pop("REMOVED", None)
+
+    MultiAuthenticator.username_prefix = None
+    MultiAuthenticator.authenticators = [
+        {"authenticator_class": RemovingDummyAuthenticator, "url_prefix": "/dummy"},
+    ]
+
+    multi_authenticator = MultiAuthenticator(cache_spawn_environment=True)
+    user = FakeUser(f"DUMMY{PREFIX_SEPARATOR}TEST", {})
+
+    for _ in range(2):
+        spawner = FakeSpawner()
+        spawner.environment["REMOVED"] = "1"
+        await multi_authenticator.pre_spawn_start(user, spawner)
+        assert spawner.environment == {}
+        await multi_authenticator.post_spawn_stop(user, spawner)
+
+
+@pytest.mark.asyncio
+async def test_spawn_hook_timeout():
+    MultiAuthenticator.username_prefix = None
+    MultiAuthenticator.authenticators = [
+        {
+            "authenticator_class": SlowDummyAuthenticator,
+            "url_prefix": "/slow",
+            "spawn_hook_timeout": 0.01,
+        },
+    ]
+
+    multi_authenticator = MultiAuthenticator()
+    assert multi_authenticator._authenticators[0].spawn_hook_timeout == 0.01
+    user = FakeUser(f"SLOW{PREFIX_SEPARATOR}TEST", {})
+
+    with pytest.raises(asyncio.TimeoutError) as excinfo:
+        await multi_authenticator.pre_spawn_start(user, FakeSpawner())
+
+    assert "pre_spawn_start of Slow timed out after 0.01s" in str(excinfo.value)
+
+
+@pytest.mark.parametrize("timeout", ["10", -1, True])
+def test_spawn_hook_timeout_validation(timeout):
+    MultiAuthenticator.username_prefix = None
+    MultiAuthenticator.authenticators = [
+        {
+            "authenticator_class": CustomDummyAuthenticator,
+            "url_prefix": "/dummy",
+            "spawn_hook_timeout": timeout,
+        },
+    ]
+
+    with pytest.raises(ValueError) as excinfo:
+        MultiAuthenticator()
+
+    assert "spawn_hook_timeout must be a non-negative number" in str(excinfo.value)
+
+
+@pytest.mark.asyncio
+async def test_spawn_hooks_shared_username_prefix():
+    class OtherSpawnHookDummyAuthenticator(CustomDummyAuthenticator):
+        login_service = "Other"
+
+        def pre_spawn_start(self, user, spawner):
+            spawner.environment["OTHER"] = "1"
+
+    MultiAuthenticator.username_prefix = "hub:"
+    MultiAuthenticator.authenticators = [
+        {
+            "authenticator_class": OtherSpawnHookDummyAuthenticator,
+            "url_prefix": "/other",
+        },
+        {"authenticator_class": SpawnHookDummyAuthenticator, "url_prefix": "/dummy"},
+    ]
+
+    multi_authenticator = MultiAuthenticator()
+    authenticated = await multi_authenticator._authenticators[1].get_authenticated_user(
+        None, {"username": "bob"}
+    )
+    assert authenticated["name"] == "HUB:BOB"
+    assert authenticated["auth_state"] == {AUTH_STATE_URL_PREFIX_KEY: "/dummy"}
+
+    user = FakeUser(
+        authenticated["name"], dict(authenticated["auth_state"], token="abc")
+    )
+    spawner = FakeSpawner()
+    await multi_authenticator.pre_spawn_start(user, spawner)
+    assert spawner.environment == {"TOKEN": "abc"}
+
+    # Without auth_state, shared prefixes cannot identify the subauthenticator
+    spawner = FakeSpawner()
+    await multi_authenticator.pre_spawn_start(FakeUser("HUB:BOB", None), spawner)
+    assert spawner.environment == {}
+
+
+@pytest.mark.asyncio
+async def test_spawn_hooks_unknown_url_prefix(caplog):
+    MultiAuthenticator.username_prefix = None
+    MultiAuthenticator.authenticators = [
+        {"authenticator_class": CustomPAMAuthenticator, "url_prefix": "/pam"},
+        {"authenticator_class": SpawnHookDummyAuthenticator, "url_prefix": "/dummy"},
+    ]
+
+    multi_authenticator = MultiAuthenticator()
+    user = FakeUser(
+        f"DUMMY{PREFIX_SEPARATOR}TEST",
+        {AUTH_STATE_URL_PREFIX_KEY: "/renamed", "token": "abc"},
+    )
+    spawner = FakeSpawner()
+    await multi_authenticator.pre_spawn_start(user, spawner)
+
+    # Falls back to the username prefix
+    assert spawner.environment == {"TOKEN": "abc"}
+    assert "Subauthenticator /renamed of DUMMY:TEST is not configured" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_stats():
+    MultiAuthenticator.username_prefix = None
+    MultiAuthenticator.authenticators = [
+        {"authenticator_class": CustomPAMAuthenticator, "url_prefix": "/pam"},
+        {"authenticator_class": SpawnHookDummyAuthenticator, "url_prefix": "/dummy"},
+    ]
+
+    multi_authenticator = MultiAuthenticator(
+        cache_spawn_environment=True, stats_latency_samples=2
+    )
+    dummy_authenticator = multi_authenticator._authenticators[1]
+    for username in ["test1", "test2", "test3"]:
+        await dummy_authenticator.get_authenticated_user(None, {"username": username})
+
+    user = FakeUser(f"DUMMY{PREFIX_SEPARATOR}TEST", {"token": "abc"})
+    for _ in range(4):
+        spawner = FakeSpawner()
+        await multi_authenticator.pre_spawn_start(user, spawner)
+        await multi_authenticator.post_spawn_stop(user, spawner)
+
+    pam_stats, dummy_stats = multi_authenticator.get_stats()
+
+    assert pam_stats["url_prefix"] == "/pam"
+    assert pam_stats["username_prefix"] == f"pam{PREFIX_SEPARATOR}"
+    assert pam_stats["class"] == (
+        f"{CustomPAMAuthenticator.__module__}.CustomPAMAuthenticator"
+    )
+    assert pam_stats["latency"] == {"p50": None, "p90": None, "p99": None}
+    assert pam_stats["spawn_environment_cache_hit_rate"] is None
+
+    assert dummy_stats["username_prefix"] == f"DUMMY{PREFIX_SEPARATOR}"
+    assert dummy_stats["in_flight"] == 0
+    assert dummy_stats["instantiation_time"] > 0
+    assert len(dummy_authenticator._stats.latencies) == 2
+    assert dummy_stats["latency"]["p99"] is not None
+    assert dummy_stats["spawn_environment_cache_hit_rate"] == 0.75
+
+
+@pytest.mark.parametrize("workers", [0, 1, 4])
+def test_construction_workers(workers):
+    MultiAuthenticator.username_prefix = None
+    MultiAuthenticator.authenticators = [
+        {"authenticator_class": "pam", "url_prefix": "/pam"},
+        {"authenticator_class": CustomDummyAuthenticator, "url_prefix": "/dummy"},
+        {
+            "authenticator_class": "oauthenticator.github.GitHubOAuthenticator",
+            "url_prefix": "/github",
+            "config": {
+                "client_id": "xxxx",
+                "client_secret": "xxxx",
+                "oauth_callback_url": "http://example.com/hub/github/oauth_callback",
+            },
+        },
+    ]
+
+    multi_authenticator = MultiAuthenticator(construction_workers=workers)
+    assert [
+        authenticator.url_scope for authenticator in multi_authenticator._authenticators
+    ] == ["/pam", "/dummy", "/github"]
+
+
+def test_construction_workers_overlap(caplog):
+    barrier = threading.Barrier(2, timeout=5)
+
+    class BarrierDummyAuthenticator(CustomDummyAuthenticator):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            # Fails with BrokenBarrierError if both are not built concurrently
+            barrier.wait()
+
+    class OtherBarrierDummyAuthenticator(BarrierDummyAuthenticator):
+        login_service = "Other"
+
+    MultiAuthenticator.username_prefix = None
+    MultiAuthenticator.authenticators = [
+        {"authenticator_class": BarrierDummyAuthenticator, "url_prefix": "/dummy"},
+        {"authenticator_class": OtherBarrierDummyAuthenticator, "url_prefix": "/other"},
+    ]
+
+    with caplog.at_level(logging.INFO):
+        multi_authenticator = MultiAuthenticator(construction_workers=2)
+
+    assert [
+        authenticator.url_scope for authenticator in multi_authenticator._authenticators
+    ] == ["/dummy", "/other"]
+    loaded = [
+        record.getMessage()
+        for record in caplog.records
+        if record.getMessage().startswith("Loaded")
+    ]
+    assert len(loaded) == 2
+    assert re.fullmatch(
+        r"Loaded Dummy for /dummy in [0-9.]+s"
+        r" \(import: [0-9.]+s, instantiation: [0-9.]+s\)",
+        loaded[0],
+    )
+    assert loaded[1].startswith("Loaded Other for /other in ")
+
+
+def test_construction_errors_aggregated(caplog):
+    class InvalidAuthenticator(CustomDummyAuthenticator):
+        login_service = f"invalid{PREFIX_SEPARATOR}"
+
+    MultiAuthenticator.username_prefix = None
+    MultiAuthenticator.authenticators = [
+        {"authenticator_class": InvalidAuthenticator, "url_prefix": "/invalid"},
+        {"authenticator_class": CustomDummyAuthenticator, "url_prefix": "/dummy"},
+        {"authenticator_class": "does.not.Exist", "url_prefix": "/missing"},
+    ]
+
+    with pytest.raises(ValueError) as excinfo:
+        MultiAuthenticator()
+
+    errors = [record for record in caplog.records if record.levelname == "ERROR"]
+    assert [record.exc_info[0] for record in errors] == [
+        ValueError,
+        ModuleNotFoundError,
+    ]
+
+    message = str(excinfo.value)
+    assert isinstance(excinfo.value.__cause__, ValueError)
+    assert "Login service cannot contain" in str(excinfo.value.__cause__)
+    assert "Failed to configure 2 subauthenticators" in message
+    assert "/invalid" in message
+    assert "/missing" in message
+    assert "/dummy" not in message
+
+
+def make_stats_handler(multi_authenticator, user, scopes):
+    application = web.Application(
+        authenticator=multi_authenticator,
+        hub=mock.Mock(base_url="/hub/"),
+        db=mock.Mock(),
+    )
+    request = HTTPServerRequest(
+        method="GET", uri=f"/hub{STATS_PATH}", connection=mock.Mock()
+    )
+    handler = StatsHandler(application, request)
+    handler._jupyterhub_user = user
+    handler.expanded_scopes = set(scopes)
+    handler.parsed_scopes = {scope: Scope.ALL for scope in scopes}
+    return handler
+
+
+@pytest.mark.parametrize(
+    "user,scopes",
+    [
+        (None, []),
+        (mock.Mock(), []),
+        (mock.Mock(), ["read:users"]),
+    ],
+)
+def test_stats_handler_forbidden(user, scopes):
+    MultiAuthenticator.username_prefix = None
+    MultiAuthenticator.authenticators = [
+        {"authenticator_class": CustomDummyAuthenticator, "url_prefix": "/dummy"},
+    ]
+
+    handler = make_stats_handler(MultiAuthenticator(), user, scopes)
+    with pytest.raises(web.HTTPError) as excinfo:
+        handler.get()
+
+    assert excinfo.value.status_code == 403
+    assert handler._write_buffer == []
+
+
+def test_stats_handler():
+    MultiAuthenticator.username_prefix = None
+    MultiAuthenticator.authenticators = [
+        {"authenticator_class": CustomDummyAuthenticator, "url_prefix": "/dummy"},
+    ]
+
+    multi_authenticator = MultiAuthenticator()
+    handler = make_stats_handler(multi_authenticator, mock.Mock(), ["read:metrics"])
+    handler.get()
+
+    assert handler._headers["Content-Type"] == "application/json"
+    stats = json.loads(b"".join(handler._write_buffer))
+    assert [entry["url_prefix"] for entry in stats] == ["/dummy"]
+    assert stats[0]["username_prefix"] == f"DUMMY{PREFIX_SEPARATOR}"
+
+
+@pytest.mark.parametrize("url_prefix", ["/api", "api/dummy", "/api/"])
+def test_url_prefix_under_api(url_prefix):
+    MultiAuthenticator.username_prefix = None
+    MultiAuthenticator.authenticators = [
+        {"authenticator_class": CustomDummyAuthenticator, "url_prefix": url_prefix},
+    ]
+
+    with pytest.raises(ValueError) as excinfo:
+        MultiAuthenticator()
+
+    assert "URL prefix cannot be under /api" in str(excinfo.value)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_construction_errors_missing_url_prefix(workers):
+    MultiAuthenticator.username_prefix = None
+    MultiAuthenticator.authenticators = [
+        {"authenticator_class": "pam"},
+        {"authenticator_class": "does.not.Exist", "url_prefix": "/missing"},
+    ]
+
+    with pytest.raises(ValueError) as excinfo:
+        MultiAuthenticator(construction_workers=workers)
+
+    message = str(excinfo.value)
+    assert "entry 0 (None): KeyError('url_prefix')" in message
+    assert "entry 1 (/missing): ModuleNotFoundError" in message
+    assert isinstance(excinfo.value.__cause__, KeyError)